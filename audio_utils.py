@@ -0,0 +1,621 @@
+r"""
+ _______                          __               __   
+|   _   |.----.----.-----.----.--|  |.---.-.-----.|  |_ 
+|       ||  __|  __|  _  |   _|  _  ||  _  |     ||   _|
+|___|___||____|____|_____|__| |_____||___._|__|__||____|
+                                                        
+             _______        __                          
+            |    ___|.----.|  |--.-----.                
+            |    ___||  __||     |  _  |                
+            |_______||____||__|__|_____|     
+            
+Algorithmic Music Generation
+
+Shared audio helpers for the engines
+
+"""
+import importlib
+import json
+import logging
+import os
+import queue
+import struct
+import subprocess
+import sys
+import time
+from threading import Thread
+
+import numpy as np
+
+LOGGER = logging.getLogger("accordant_echo")
+STARTED = time.perf_counter()
+
+# Options not given on the command line are read from the environment, i.e.
+# ACCORDANT_MIDI_RECORD for --midi-record, then from the config file
+ENV_PREFIX = "ACCORDANT_"
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "accordant.json")
+_CONFIG = None
+
+# Seconds between WAV header fixups while recording
+FIXUP_INTERVAL = 2.0
+# Largest WAV data chunk, its size is a 32 bit field, longer takes continue in a new file
+MAX_WAV_DATA = 0xFFFFFFFF - 36
+
+# Block size tuning
+MIN_BLOCK = 32
+MAX_BLOCK = 4096
+HEADROOM = 0.5  # fraction of the deadline a block may spend rendering
+CALIBRATION_RUNS = 64
+MISS_WINDOW = 1000  # blocks per runtime evaluation window
+MAX_MISSES = 3  # deadline misses per window before the block size grows
+STABLE_WINDOWS = 8  # clean windows before the block size shrinks again
+
+
+def load_config():
+    """
+    Load the JSON config file, given by --config or ACCORDANT_CONFIG, or `CONFIG_PATH`.
+
+    Returns:
+        dict: Options by name, empty if there is no config file.
+    """
+    global _CONFIG
+
+    if _CONFIG is None:
+        path = None
+        for arg in sys.argv[1:]:
+            if arg.startswith("--config="):
+                path = arg.split("=", 1)[1]
+        path = path or os.environ.get(f"{ENV_PREFIX}CONFIG", CONFIG_PATH)
+        _CONFIG = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as handle:
+                _CONFIG = json.load(handle)
+    return _CONFIG
+
+
+def get_option(name, default=None):
+    """
+    Get the value of an option.
+
+    The option is looked up as a `--name=value` command line argument, then as an
+    ACCORDANT_NAME environment variable, then as a key of the config file.
+
+    Args:
+        name (str): Name of the option, without the leading dashes.
+        default (any, optional): Value returned when the option is not given.
+
+    Returns:
+        any: The option value, or `default`.
+    """
+    for arg in sys.argv[1:]:
+        if arg.startswith(f"--{name}="):
+            return arg.split("=", 1)[1]
+    env = f"{ENV_PREFIX}{name.upper().replace('-', '_')}"
+    if env in os.environ:
+        return os.environ[env]
+    return load_config().get(name, default)
+
+
+def get_connect():
+    """
+    Get the MIDI connection argument for `MidiPort`.
+
+    Returns:
+        str/bool: The first positional command line argument, else the "port" option,
+            else True for UI connection.
+    """
+    args = [i for i in sys.argv[1:] if not i.startswith("--")]
+    return args[0] if args else get_option("port", True)
+
+
+def get_dtype():
+    """
+    Get the sample format of the audio path from the "precision" option.
+
+    Returns:
+        np.dtype: float64 by default, or float32 to halve the memory bandwidth and cache
+            footprint of sample banks and buffers.
+
+    Raises:
+        ValueError: If the precision is not float32 or float64.
+    """
+    precision = get_option("precision", "float64")
+    if precision not in ("float32", "float64"):
+        raise ValueError(f"Precision must be either 'float32' or 'float64', got '{precision}'")
+    return np.dtype(precision)
+
+
+def setup_logging():
+    """Log to the file given by the "log" option, or to the terminal."""
+    logging.basicConfig(
+        filename=get_option("log"), level=logging.INFO, format="%(asctime)s %(message)s"
+    )
+
+
+def preload(*modules):
+    """
+    Import modules in the background, so importing them later doesn't stall startup.
+
+    Args:
+        modules (str): Names of the modules to import.
+    """
+    for module in modules:
+        Thread(target=importlib.import_module, args=(module,), daemon=True).start()
+
+
+def log_startup():
+    """Log the time from startup to the first audio block, once."""
+    global STARTED
+
+    if STARTED is not None:
+        LOGGER.info("first audio block after %.0f ms", (time.perf_counter() - STARTED) * 1000)
+        STARTED = None
+
+
+def elevate_priority(pid=None):
+    """
+    Renice a process or thread for real-time priority, without ever prompting.
+
+    This works if the user may raise priorities, i.e. with CAP_SYS_NICE or an rtprio
+    limit, or may run renice through sudo without a password.
+
+    Args:
+        pid (int, optional): Process id, or native thread id, defaults to this process.
+    """
+    pid = pid or os.getpid()
+    try:
+        os.setpriority(os.PRIO_PROCESS, pid, -20)
+        return
+    except (AttributeError, OSError):
+        pass
+    # auto-renice to increase process priority
+    try:
+        result = subprocess.run(
+            ["sudo", "-n", "renice", "-n", "-20", "-p", str(pid)],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            check=False,
+        )
+        if not result.returncode:
+            return
+    except OSError:
+        pass
+    LOGGER.warning("could not raise the priority of %d, running at normal priority", pid)
+
+
+class NullPlayer:
+    """Stand-in for a soundcard player that discards the audio, to render unthrottled."""
+
+    latency = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+    def play(self, data):
+        """Discard a block of audio."""
+
+
+class RenderStats:
+    """Collects render times of an engine, to benchmark it."""
+
+    def __init__(self, sample_rate):
+        """
+        Initialize RenderStats object.
+
+        Args:
+            sample_rate (int): Sample rate of the engine.
+        """
+        self.sample_rate = sample_rate
+        self.start = time.perf_counter()
+        self.blocks = 0
+        self.frames = 0
+        self.render = 0.0
+        self.worst = 0.0
+
+    def add(self, render_time, frames):
+        """
+        Account for one rendered block.
+
+        Args:
+            render_time (float): Seconds spent rendering the block.
+            frames (int): Number of frames in the block.
+        """
+        self.blocks += 1
+        self.frames += frames
+        self.render += render_time
+        self.worst = max(self.worst, render_time)
+
+    def summary(self):
+        """
+        Summarize the collected render times.
+
+        Returns:
+            str: Human readable summary.
+        """
+        audio = self.frames / self.sample_rate
+        return (
+            f"{self.blocks} blocks, {audio:.2f} s of audio rendered in {self.render:.3f} s "
+            f"({audio / max(self.render, 1e-9):.1f}x realtime) "
+            f"and {time.perf_counter() - self.start:.3f} s wall time, "
+            f"worst block {self.worst * 1000:.3f} ms"
+        )
+
+
+class MixerBus:
+    """
+    Mixes the blocks of several engines into one preallocated output buffer.
+
+    An engine is anything with a `render(frames)` method returning a block of that many
+    frames, mono engines are spread over all channels of the bus.
+    """
+
+    def __init__(self, channels=1, max_frames=MAX_BLOCK, dtype=float):
+        """
+        Initialize MixerBus object.
+
+        Args:
+            channels (int, optional): Number of output channels.
+            max_frames (int, optional): Largest block size that will be rendered.
+            dtype (np.dtype, optional): Sample format of the bus.
+        """
+        self.channels = channels
+        self.buffer = np.zeros((max_frames, channels), dtype=dtype)
+        self.scratch = np.zeros((max_frames, channels), dtype=dtype)
+        self.engines = []
+
+    def add(self, engine, gain=1.0):
+        """
+        Add an engine to the bus.
+
+        Args:
+            engine (object): Engine to render every block.
+            gain (float, optional): Gain applied to the engine's output.
+        """
+        self.engines.append([engine, gain])
+
+    def render(self, frames):
+        """
+        Render every engine and mix them.
+
+        Args:
+            frames (int): Number of frames to render.
+
+        Returns:
+            np.ndarray: View of the bus buffer holding the mixed block.
+        """
+        out = self.buffer[:frames]
+        out.fill(0)
+        for engine, gain in self.engines:
+            block = engine.render(frames).reshape(frames, -1)
+            scaled = self.scratch[:frames, : block.shape[1]]
+            np.multiply(block, gain, out=scaled)
+            out += scaled
+        return out
+
+
+class StreamRecorder:
+    """
+    Record the output stream to disk without blocking the audio loop.
+
+    The audio thread only copies each block into a preallocated slot and hands the slot
+    index to a background thread, which streams it to disk.  If the writer falls behind
+    and no slot is free, the block is dropped and counted rather than waited for.  WAV
+    takes that would outgrow the format continue in numbered files, i.e. take.2.wav.
+    """
+
+    def __init__(self, path, sample_rate, channels=1, max_frames=4096, slots=256):
+        """
+        Initialize StreamRecorder object and start the writer thread.
+
+        Args:
+            path (str): Output file; `.wav` files get a 32 bit float WAV header that is
+                fixed up periodically, anything else is written as raw interleaved float32.
+            sample_rate (int): Sample rate of the stream.
+            channels (int, optional): Number of channels to record.
+            max_frames (int, optional): Largest block size that will be pushed.
+            slots (int, optional): Number of preallocated blocks in the queue.
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.max_frames = max_frames
+        self.wav = path.lower().endswith(".wav")
+        self.dropped = 0
+        self.reported = 0
+        self.frames = 0
+        self.part = 1
+        self.error = None
+        self.closed = False
+
+        self.buffers = np.zeros((slots, max_frames, channels), dtype=np.float32)
+        self.lengths = [0] * slots
+        self.free = queue.SimpleQueue()
+        self.filled = queue.SimpleQueue()
+        for slot in range(slots):
+            self.free.put(slot)
+
+        self.handle = open(path, "wb")
+        if self.wav:
+            self._write_header()
+        self.thread = Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def push(self, block, wait=False):
+        """
+        Queue a block of audio for recording, called from the audio thread.
+
+        Args:
+            block (np.ndarray): Audio block, shaped (frames,) or (frames, channels).
+            wait (bool, optional): Wait for a free slot instead of dropping the block, for
+                offline renders that have no deadline to keep.
+
+        Returns:
+            bool: False if the block had to be dropped.
+        """
+        frames = block.shape[0]
+        data = block.reshape(frames, -1)
+        if frames > self.max_frames or data.shape[1] not in (1, self.channels):
+            self.dropped += 1
+            return False
+        try:
+            slot = self.free.get(block=wait)
+        except queue.Empty:
+            self.dropped += 1
+            return False
+        self.buffers[slot, :frames] = data
+        self.lengths[slot] = frames
+        self.filled.put(slot)
+        return True
+
+    def close(self):
+        """Flush all queued blocks, finalize the header and close the file."""
+        if self.closed:
+            return
+        self.closed = True
+        self.filled.put(None)
+        self.thread.join()
+        try:
+            with self.handle:
+                if self.wav:
+                    self._write_header()
+        except Exception as error:
+            LOGGER.error("could not finalize the recording %s: %s", self.handle.name, error)
+        if self.dropped:
+            LOGGER.warning(
+                "%d blocks dropped while recording %s, the take has gaps", self.dropped, self.path
+            )
+
+    def _writer(self):
+        """Background thread streaming queued blocks to disk."""
+        last_fixup = time.monotonic()
+        while (slot := self.filled.get()) is not None:
+            try:
+                # after a failure the rest of the take is discarded, the error was logged
+                if not self.error:
+                    self._write(slot)
+                    if time.monotonic() - last_fixup > FIXUP_INTERVAL:
+                        self._fixup()
+                        last_fixup = time.monotonic()
+            except Exception as error:
+                # i.e. a full disk, the audio loop keeps running without the recording
+                LOGGER.error("recording to %s stopped: %s", self.handle.name, error)
+                self.error = error
+            finally:
+                self.free.put(slot)
+
+    def _write(self, slot):
+        """Write a queued block, continuing in the next file when a WAV file is full."""
+        data = self.buffers[slot, : self.lengths[slot]]
+        if self.wav and (self.frames + data.shape[0]) * self.channels * 4 > MAX_WAV_DATA:
+            self._write_header()
+            self.handle.close()
+            self.part += 1
+            root, ext = os.path.splitext(self.path)
+            path = f"{root}.{self.part}{ext}"
+            LOGGER.info("recording reached the WAV size limit, continuing in %s", path)
+            self.handle = open(path, "wb")
+            self.frames = 0
+            self._write_header()
+        self.handle.write(data.tobytes())
+        self.frames += data.shape[0]
+
+    def _fixup(self):
+        """Keep the file valid on disk so a crashed session is still readable."""
+        if self.wav:
+            self._write_header()
+        self.handle.flush()
+        if self.dropped > self.reported:
+            LOGGER.warning(
+                "%d blocks dropped while recording, the writer is falling behind",
+                self.dropped - self.reported,
+            )
+            self.reported = self.dropped
+
+    def _write_header(self):
+        """Write or rewrite the WAV header with the current data size."""
+        data_size = self.frames * self.channels * 4
+        position = self.handle.tell()
+        self.handle.seek(0)
+        self.handle.write(
+            struct.pack(
+                "<4sI4s4sIHHIIHH4sI",
+                b"RIFF",
+                36 + data_size,
+                b"WAVE",
+                b"fmt ",
+                16,
+                3,  # IEEE float
+                self.channels,
+                self.sample_rate,
+                self.sample_rate * self.channels * 4,
+                self.channels * 4,
+                32,
+                b"data",
+                data_size,
+            )
+        )
+        if position:
+            self.handle.seek(position)
+
+
+class BlockSizeTuner:
+    """
+    Pick and maintain the smallest block size an engine can render safely.
+
+    A block of `n` frames has to render within `n / sample_rate` seconds to keep up, and,
+    because the device only buffers `latency` seconds ahead of the speaker, within the
+    device latency as well.  The smaller of the two is the block's deadline.
+    """
+
+    def __init__(self, sample_rate, block_size, latency=None, adaptive=False):
+        """
+        Initialize BlockSizeTuner object.
+
+        Args:
+            sample_rate (int): Sample rate of the engine.
+            block_size (int): Block size to use until calibrated.
+            latency (float, optional): Latency reported by the device in seconds.
+            adaptive (bool, optional): Whether `update` may change the block size at runtime.
+        """
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.latency = latency or None
+        self.adaptive = adaptive
+        self.floor = MIN_BLOCK
+        # past the device latency a bigger block only adds render time to the same deadline
+        self.ceiling = MIN_BLOCK
+        while self.ceiling < MAX_BLOCK and (
+            not self.latency or self.ceiling < self.latency * sample_rate
+        ):
+            self.ceiling *= 2
+        self.blocks = 0
+        self.misses = 0
+        self.worst = 0.0
+        self.stable = 0
+
+    def deadline(self, block_size):
+        """
+        Get the time available to render a block.
+
+        Args:
+            block_size (int): Number of frames in the block.
+
+        Returns:
+            float: Deadline in seconds.
+        """
+        deadline = block_size / self.sample_rate
+        if self.latency:
+            deadline = min(deadline, self.latency)
+        return deadline
+
+    def calibrate(self, render):
+        """
+        Measure render times and select the smallest safe block size.
+
+        Args:
+            render (callable): Function rendering a block of the given number of frames.
+
+        Returns:
+            int: The selected block size.
+        """
+        block_size = MIN_BLOCK
+        while True:
+            times = []
+            for _ in range(CALIBRATION_RUNS):
+                start = time.perf_counter()
+                render(block_size)
+                times.append(time.perf_counter() - start)
+            # ignore the slowest few runs, those are the scheduler rather than the engine
+            render_time = sorted(times)[int(len(times) * 0.95)]
+            if render_time <= HEADROOM * self.deadline(block_size) or block_size >= self.ceiling:
+                break
+            block_size *= 2
+
+        self._log(
+            "calibrated",
+            block_size,
+            f"render {render_time * 1000:.2f} ms of {self.deadline(block_size) * 1000:.2f} ms",
+        )
+        self.block_size = self.floor = block_size
+        return block_size
+
+    def update(self, render_time):
+        """
+        Account for one rendered block and adjust the block size if needed.
+
+        Args:
+            render_time (float): Seconds spent rendering the last block.
+
+        Returns:
+            int: The block size to render next.
+        """
+        if not self.adaptive:
+            return self.block_size
+        self.blocks += 1
+        self.worst = max(self.worst, render_time)
+        if render_time > self.deadline(self.block_size):
+            self.misses += 1
+
+        if self.misses > MAX_MISSES and self.block_size < self.ceiling:
+            # grow straight away, every further miss is an audible dropout
+            self._resize(
+                self.block_size * 2,
+                f"{self.misses} deadline misses in {self.blocks} blocks, "
+                f"worst render {self.worst * 1000:.2f} ms",
+                logging.WARNING,
+            )
+            self.stable = 0
+        elif self.blocks >= MISS_WINDOW:
+            if self.misses > MAX_MISSES:
+                LOGGER.warning(
+                    "%d deadline misses in %d blocks at the largest block size %d, "
+                    "worst render %.2f ms",
+                    self.misses,
+                    self.blocks,
+                    self.block_size,
+                    self.worst * 1000,
+                )
+            self.stable = self.stable + 1 if not self.misses else 0
+            smaller = self.block_size // 2
+            if (
+                self.stable >= STABLE_WINDOWS
+                and smaller >= self.floor
+                and self.worst / 2 <= HEADROOM * self.deadline(smaller)
+            ):
+                self._resize(
+                    smaller,
+                    f"no deadline misses in {self.stable} windows, "
+                    f"worst render {self.worst * 1000:.2f} ms",
+                )
+                self.stable = 0
+            self.blocks = self.misses = 0
+            self.worst = 0.0
+        return self.block_size
+
+    def _resize(self, block_size, reason, level=logging.INFO):
+        """Change the block size and start a new evaluation window."""
+        self._log(f"{self.block_size} ->", block_size, reason, level)
+        self.block_size = block_size
+        self.blocks = self.misses = 0
+        self.worst = 0.0
+
+    def _log(self, action, block_size, reason, level=logging.INFO):
+        """Log a block size decision with the latency it implies."""
+        latency = block_size / self.sample_rate + (self.latency or 0)
+        LOGGER.log(
+            level,
+            "block size %s %d (%.1f ms output latency): %s",
+            action,
+            block_size,
+            latency * 1000,
+            reason,
+        )
@@ -0,0 +1,171 @@
+r"""
+ _______                          __               __   
+|   _   |.----.----.-----.----.--|  |.---.-.-----.|  |_ 
+|       ||  __|  __|  _  |   _|  _  ||  _  |     ||   _|
+|___|___||____|____|_____|__| |_____||___._|__|__||____|
+                                                        
+             _______        __                          
+            |    ___|.----.|  |--.-----.                
+            |    ___||  __||     |  _  |                
+            |_______||____||__|__|_____|     
+
+Algorithmic Music Generation
+
+Beat Sampler
+
+Runs the generative beats of `gen_beat` straight into the drum sampler in one process,
+triggering every hit at its exact sample instead of going through MIDI.
+
+"""
+import os
+import time
+from collections import deque
+from threading import Thread, get_native_id
+
+import gen_beat
+from audio_utils import (
+    StreamRecorder,
+    elevate_priority,
+    get_option,
+    log_startup,
+    preload,
+    setup_logging,
+)
+from drum_sampler import CHOP_SIZE, PATH, DrumSampler, load_samples, select_kit
+
+# Seconds of hits the sequencer schedules ahead of the audio thread
+LOOKAHEAD = 0.05
+# gen_beat always plays its notes at this velocity
+VELOCITY = 100
+
+
+class Sequencer:
+    """
+    Run the `gen_beat` pattern on the sample clock of the audio thread.
+
+    Hits are queued up to `LOOKAHEAD` seconds ahead as (frame, sample index, velocity)
+    events.  The event queue is a deque, which one thread can append to while another
+    pops from it without any locking.
+    """
+
+    def __init__(self, buffer, sample_rate):
+        """
+        Initialize Sequencer object.
+
+        Args:
+            buffer (dict): Pattern buffer, as created by `gen_beat.new_buffer`.
+            sample_rate (int): Sample rate of the audio thread.
+        """
+        self.buffer = buffer
+        self.sample_rate = sample_rate
+        self.events = deque()
+        self.frame = 0
+        # kept as a float so the step lengths don't accumulate rounding errors
+        self.next_step = LOOKAHEAD * sample_rate
+        self.idx = 0
+
+    def run(self):
+        """Schedule the hits of the pattern until the buffer is killed."""
+        while not self.buffer["kill"]:
+            while self.next_step < self.frame + LOOKAHEAD * self.sample_rate:
+                frame = round(self.next_step)
+                for note in gen_beat.step_notes(self.buffer, self.idx):
+                    self.events.append((frame, gen_beat.scale(note) % 12, VELOCITY))
+
+                self.idx += 1
+                if self.idx >= len(self.buffer["notes"]) * 2:
+                    self.idx = 0
+
+                gen_beat.show(self.buffer, self.idx)
+                self.next_step += gen_beat.calculate_sleep_duration(self.idx) * self.sample_rate
+            time.sleep(LOOKAHEAD / 4)
+
+    def trigger(self, sampler, chop_size):
+        """
+        Start the hits due within the next block and advance the clock past it.
+
+        Args:
+            sampler (DrumSampler): Sampler playing the hits.
+            chop_size (int): Number of frames in the block.
+        """
+        block_end = self.frame + chop_size
+        while self.events and self.events[0][0] < block_end:
+            frame, note, vel = self.events.popleft()
+            # late hits start with the block rather than skipping into the sample
+            sampler.trigger(note, vel, min(self.frame - frame, 0))
+        self.frame = block_end
+
+
+def play(sequencer, sampler, recorder=None):
+    """
+    Audio thread mixing the sequenced hits and playing them on the default speaker.
+
+    Args:
+        sequencer (Sequencer): Sequencer providing the hits.
+        sampler (DrumSampler): Sampler playing the hits.
+        recorder (StreamRecorder, optional): Recorder to push every played block to.
+    """
+    # only the audio thread gets real-time priority
+    elevate_priority(get_native_id())
+    import soundcard
+
+    speaker = soundcard.default_speaker()
+    with speaker.player(samplerate=sampler.sample_rate, blocksize=512) as spk:
+        while not sequencer.buffer["kill"]:
+            sequencer.trigger(sampler, CHOP_SIZE)
+            play_buffer = sampler.render(CHOP_SIZE)
+            spk.play(play_buffer)
+            log_startup()
+            if recorder:
+                recorder.push(play_buffer)
+
+
+def main():
+    """
+    Main function to run the beat sampler.
+    """
+    # i.e. --log=beats.log
+    setup_logging()
+    # soundcard is slow to import, let it load while the kit is set up
+    preload("soundcard")
+    drumkits = sorted(os.listdir(os.path.join(PATH, "drumkits")))
+    sampler = DrumSampler(*load_samples(drumkits, select_kit(drumkits)))
+
+    # Optionally record everything sent to the speaker, i.e. --record=take.wav
+    recorder = None
+    if record := get_option("record"):
+        recorder = StreamRecorder(
+            record, sampler.sample_rate, sampler.channels, max_frames=CHOP_SIZE
+        )
+
+    buffer = gen_beat.new_buffer()
+    sequencer = Sequencer(buffer, sampler.sample_rate)
+    # Generate samples based on harmonic information
+    probabilities = list(map(gen_beat.prob_from_harmonic, gen_beat.FREQUENCY.values()))
+
+    threads = [
+        Thread(target=sequencer.run, daemon=True),
+        Thread(target=play, args=(sequencer, sampler, recorder), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            gen_beat.mutate(buffer, probabilities)
+            time.sleep(gen_beat.CONFIG["mutate"])
+
+    except KeyboardInterrupt:
+        # the ^C from the signal will complete this message; i.e. ^Cleaning up^
+        print("leaning up^")
+
+    finally:
+        buffer["kill"] = True
+        for thread in threads:
+            thread.join()
+        if recorder:
+            recorder.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+r"""
+ _______                          __               __   
+|   _   |.----.----.-----.----.--|  |.---.-.-----.|  |_ 
+|       ||  __|  __|  _  |   _|  _  ||  _  |     ||   _|
+|___|___||____|____|_____|__| |_____||___._|__|__||____|
+                                                        
+             _______        __                          
+            |    ___|.----.|  |--.-----.                
+            |    ___||  __||     |  _  |                
+            |_______||____||__|__|_____|     
+
+Algorithmic Music Generation
+
+Benchmark
+
+Renders the engines without a sound device in both precisions, to compare float64 and
+float32 audio paths, i.e. `python benchmark.py --kit=808`.
+
+"""
+import os
+import random
+from time import perf_counter
+
+import numpy as np
+
+from audio_utils import MAX_BLOCK, get_option
+from drum_sampler import CHOP_SIZE, PATH, DrumSampler, load_samples, resolve_kit
+from poly_synth import BATCH, CALIBRATION_VOICES, PolySynth
+from rtmidi_utils import MidiMessage
+
+BLOCKS = 500
+REPEATS = 5  # the fastest run counts, slower ones are the scheduler rather than the engine
+PRECISIONS = ("float64", "float32")
+
+# Small blocks are bound by the Python overhead per voice, which is the same in either
+# precision, large blocks with many voices by memory bandwidth, which float32 halves
+CASES = [
+    ("drum_sampler", "drums", CHOP_SIZE, 1),
+    ("drum_sampler, dense", "drums", MAX_BLOCK, 16),
+    ("poly_synth", "synth", BATCH, CALIBRATION_VOICES),
+    ("poly_synth, dense", "synth", MAX_BLOCK, 32),
+]
+
+
+def bench_drums(dtype, frames, hits):
+    """
+    Time the drum sampler playing a stream of random hits.
+
+    Args:
+        dtype (np.dtype): Sample format to render in.
+        frames (int): Number of frames per block.
+        hits (int): Number of hits per block.
+
+    Returns:
+        float: Seconds per block.
+    """
+    drumkits = sorted(os.listdir(os.path.join(PATH, "drumkits")))
+    samples, sample_rate = load_samples(
+        drumkits, resolve_kit(drumkits, get_option("kit", "808")), dtype=dtype
+    )
+    sampler = DrumSampler(samples, sample_rate)
+    slots = [slot for slot, layers in enumerate(samples) if layers]
+    rng = random.Random(0)
+
+    start = perf_counter()
+    for _ in range(BLOCKS):
+        for _ in range(hits):
+            sampler.trigger(rng.choice(slots), rng.randint(1, 127), -rng.randrange(frames))
+        sampler.render(frames)
+    return (perf_counter() - start) / BLOCKS
+
+
+def bench_synth(dtype, frames, voices):
+    """
+    Time the polysynth holding a chord.
+
+    Args:
+        dtype (np.dtype): Sample format to render in.
+        frames (int): Number of frames per block.
+        voices (int): Number of notes held.
+
+    Returns:
+        float: Seconds per block.
+    """
+    synth = PolySynth(48000, dtype=dtype)
+    for note in range(voices):
+        synth.handle(MidiMessage([0x90, 36 + note, 100]))
+    # the first block loads the patchbay
+    synth.render(frames)
+
+    start = perf_counter()
+    for _ in range(BLOCKS):
+        synth.render(frames)
+    return (perf_counter() - start) / BLOCKS
+
+
+def main():
+    """
+    Main function to run the benchmarks and print the speedup of float32.
+    """
+    benches = {"drums": bench_drums, "synth": bench_synth}
+    for name, engine, frames, load in CASES:
+        times = {
+            precision: min(
+                benches[engine](np.dtype(precision), frames, load) for _ in range(REPEATS)
+            )
+            for precision in PRECISIONS
+        }
+        print(
+            f"{name} ({frames} frames): "
+            + ", ".join(f"{key} {value * 1000:.3f} ms/block" for key, value in times.items())
+            + f", float32 speedup {times['float64'] / times['float32']:.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -16,33 +16,84 @@ Drum Sampler
 """
 import curses
 import json
+import math
 import os
 import sys
 import warnings
+from functools import partial
+from math import gcd
 from statistics import mode
+from time import perf_counter
 
 import numpy as np
-import soundcard
-from readchar import readchar
-from scipy.io import wavfile
 
-from rtmidi_utils import MidiPort
+from audio_utils import (
+    MAX_BLOCK,
+    BlockSizeTuner,
+    NullPlayer,
+    RenderStats,
+    StreamRecorder,
+    get_connect,
+    elevate_priority,
+    get_dtype,
+    get_option,
+    log_startup,
+    preload,
+    setup_logging,
+)
+from rtmidi_utils import MidiPort, MidiReplayPort
 
 PATH = str(os.path.dirname(os.path.abspath(__file__))) + "/"
 CHOP_SIZE = 256
 
+# Drum sounds by their file name, in the same order as they would be on an 808
+SLOTS = [
+    "kick",
+    "snare",
+    "lowtom",
+    "tom",
+    "hitom",
+    "perc",
+    "clap",
+    "cowbell",
+    "crash",
+    "openhat",
+    "closedhat",
+    None,
+]
+# Other file names used for the drum sounds
+ALIASES = {"hihat": "closedhat"}
+# Drum sounds that cut each other off, i.e. a closed hat stops a ringing open hat
+CHOKE_GROUPS = {"openhat": "hats", "closedhat": "hats"}
+# Voices are culled once the peak left in their sample, scaled by their gain, drops below
+# this many dBFS
+CULL_DB = -60
+# Choked and culled voices fade out over this many frames rather than stopping with a click
+FADE_FRAMES = 256
 
-def load_samples(drumkits, kit_number):
+
+def load_samples(drumkits, kit_number, sample_rate=None, dtype=None):
     """
     Load drum samples from the specified drumkit.
 
+    Velocity layers are named with a number, from the softest to the hardest hit, i.e.
+    snare_1.wav, snare_2.wav, snare_3.wav.
+
     Args:
         drumkits (list): List of available drumkit names.
         kit_number (int): Index of the selected drumkit.
+        sample_rate (int, optional): Resample the kit to this rate, i.e. to share a device
+            with other engines.
+        dtype (np.dtype, optional): Sample format, defaults to the "precision" option.
 
     Returns:
-        tuple: A tuple containing the loaded samples and the sample rate.
+        tuple: A tuple containing the loaded samples, a list of layers or None for each
+            slot, and the sample rate.
     """
+    # scipy is slow to import, only pay for it once there is a kit to load
+    from scipy.io import wavfile
+
+    dtype = dtype if dtype is not None else get_dtype()
     kit_path = os.path.join(PATH, "drumkits", drumkits[kit_number])
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
@@ -53,116 +104,347 @@ def load_samples(drumkits, kit_number):
         }
 
     # Determine the most common sample rate among the loaded samples
-    sample_rate = mode([i[0] for i in samples.values()])
+    kit_rate = mode([i[0] for i in samples.values()])
+    if sample_rate and sample_rate != kit_rate:
+        from scipy.signal import resample_poly
 
-    # Extract the audio data from the loaded samples
-    samples = {k: v[1] for k, v in samples.items()}
+        divisor = gcd(sample_rate, kit_rate)
+        up, down = sample_rate // divisor, kit_rate // divisor
+
+    layers = {}
+    for name, (_, sample) in samples.items():
+        base, _, layer = name.rpartition("_")
+        if not (base and layer.isdigit()):
+            base, layer = name, 0
+        # Normalize the samples and convert them to floating point format
+        if sample.dtype == np.int32:
+            sample = sample.astype(dtype) / 2147483647
+        elif sample.dtype == np.int16:
+            sample = sample.astype(dtype) / 65535
+        elif np.issubdtype(sample.dtype, np.floating):
+            sample = sample.astype(dtype)
+        else:
+            # Unsupported type
+            continue
+        if sample_rate and sample_rate != kit_rate:
+            sample = resample_poly(sample, up, down, axis=0).astype(dtype)
+        layers.setdefault(ALIASES.get(base, base), []).append((int(layer), sample))
 
     # sort the samples to be in the same arder as they would be on an 808
     samples = [
-        samples.get("kick", None),
-        samples.get("snare", None),
-        samples.get("lowtom", None),
-        samples.get("tom", None),
-        samples.get("hitom", None),
-        samples.get("perc", None),
-        samples.get("clap", None),
-        samples.get("cowbell", None),
-        samples.get("crash", None),
-        samples.get("openhat", None),
-        samples.get("closedhat", None),
-        None,
+        [i[1] for i in sorted(layers[name], key=lambda i: i[0])] if name in layers else None
+        for name in SLOTS
     ]
+    return samples, sample_rate or kit_rate
 
-    new_samples = []
-    # Normalize the samples and convert them to floating point format
-    for sample in samples:
-        if sample is None:
-            new_samples.append(None)
-        elif sample.dtype == np.int32:
-            new_samples.append(sample.astype(float) / 2147483647)
-        elif sample.dtype == np.int16:
-            new_samples.append(sample.astype(float) / 65535)
-        elif sample.dtype == float:
-            new_samples.append(sample)
+
+def tail_peak(sample):
+    """
+    Compute the peak level left in a sample from every position to its end.
+
+    Args:
+        sample (np.ndarray): Sample, shaped (frames,) or (frames, channels).
+
+    Returns:
+        np.ndarray: Remaining peak in dBFS at each frame, in the format of the sample.
+    """
+    peak = np.abs(sample).reshape(sample.shape[0], -1).max(axis=1)
+    peak = np.maximum.accumulate(peak[::-1])[::-1]
+    return 20 * np.log10(np.maximum(peak, 1e-10))
+
+
+def resolve_kit(drumkits, kit):
+    """
+    Resolve a drumkit name or id to its index.
+
+    Args:
+        drumkits (list): List of available drumkit names.
+        kit (str/int): Name or id of the drumkit.
+
+    Returns:
+        int: Index of the drumkit.
+    """
+    return drumkits.index(kit) if kit in drumkits else int(kit)
+
+
+def select_kit(drumkits):
+    """
+    Select a drumkit by the "kit" option, its name or id, or else by prompting the user.
+
+    Args:
+        drumkits (list): List of available drumkit names.
+
+    Returns:
+        int: Index of the selected drumkit.
+    """
+    if (kit := get_option("kit")) is None:
+        print("\033c")  # Clear the screen
+        print(json.dumps(dict(enumerate(drumkits)), indent=4))  # Print available drumkits
+        kit = input("Select drumkit id: ")  # Prompt user to select a drumkit
+    return resolve_kit(drumkits, kit)
+
+
+def mix_block(playing, chop_size, play_buffer):
+    """
+    Mix the next block of all currently playing voices.
+
+    Args:
+        playing (list): Playing voices, as created by `DrumSampler.voice`.
+        chop_size (int): Number of frames to mix.
+        play_buffer (np.ndarray): Preallocated buffer to mix into, at least `chop_size`
+            frames long.
+
+    Returns:
+        tuple: A tuple containing the mixed block and the voices still playing.
+    """
+    # Initialize buffer for playing sounds
+    play_buffer = play_buffer[:chop_size]
+    play_buffer.fill(0)
+    kill = []
+    # Generate audio buffer based on currently playing voices
+    for idx, (sample, position, gain, tail, _, fade_at) in enumerate(playing):
+        # a negative position starts the voice that many frames into the block
+        offset = max(-position, 0)
+        start = max(position, 0)
+        sample_chunk = sample[start : start + max(chop_size - offset, 0)]
+        # cull voices once there is nothing audible left in them
+        if fade_at is None and tail[start] + 20 * math.log10(gain) < CULL_DB:
+            fade_at = playing[idx][5] = start
+        if fade_at is None:
+            play_buffer[offset : offset + sample_chunk.shape[0]] += sample_chunk * gain
         else:
-            # Unsupported type
-            new_samples.append(None)
+            # fade out from the fade position on, rather than cutting off with a click
+            ramp = np.arange(start, start + sample_chunk.shape[0], dtype=sample.dtype)
+            ramp = np.clip((fade_at + FADE_FRAMES - ramp) * (gain / FADE_FRAMES), 0, gain)
+            play_buffer[offset : offset + sample_chunk.shape[0]] += (sample_chunk.T * ramp).T
+        position = playing[idx][1] = position + chop_size
+        if position >= sample.shape[0] or (
+            fade_at is not None and position >= fade_at + FADE_FRAMES
+        ):
+            kill.append(idx)
+    # Remove finished voices from the list of playing voices
+    for i in kill:
+        playing[i] = 0
+    return play_buffer, [i for i in playing if i]
+
+
+class DrumSampler:
+    """Drum sampler engine playing a loaded kit."""
+
+    name = "Python Drum Sampler"
+
+    def __init__(self, samples, sample_rate, max_frames=MAX_BLOCK):
+        """
+        Initialize DrumSampler object.
+
+        Args:
+            samples (list): Loaded samples, as returned by `load_samples`.
+            sample_rate (int): Sample rate of the samples.
+            max_frames (int, optional): Largest block size that will be rendered.
+        """
+        self.sample_rate = sample_rate
+        self.max_frames = max_frames
+        self.buffer = None
+        self.playing = []
+        self.load(samples)
+
+    def load(self, samples):
+        """
+        Switch to a kit, computing the tail peak tables used to cull voices.
+
+        Args:
+            samples (list): Loaded samples, as returned by `load_samples`.
+        """
+        self.samples = samples
+        self.tails = [
+            None if layers is None else [tail_peak(layer) for layer in layers] for layers in samples
+        ]
+        first = next(layers[0] for layers in samples if layers)
+        self.channels = first.shape[1] if first.ndim == 2 else 1
+        shape = (self.max_frames,) + first.shape[1:]
+        if self.buffer is None or self.buffer.shape != shape or self.buffer.dtype != first.dtype:
+            self.buffer = np.zeros(shape, dtype=first.dtype)
+
+    def voice(self, slot, vel, position=0):
+        """
+        Create a voice for a hit.
+
+        Args:
+            slot (int): Index of the drum sound.
+            vel (int): MIDI velocity of the hit, picks the layer and scales the gain.
+            position (int, optional): Position in the sample, negative to start the voice
+                that many frames into the next block.
 
-    return new_samples, sample_rate
+        Returns:
+            list: The voice, as [sample, position, gain, tail peak, slot, fade position],
+                the fade position being None until the voice is choked or culled.
+        """
+        layers = self.samples[slot]
+        layer = min(vel * len(layers) // 128, len(layers) - 1)
+        return [layers[layer], position, vel / 127, self.tails[slot][layer], slot, None]
+
+    def trigger(self, slot, vel, position=0):
+        """
+        Play a hit, choking the voices of its choke group.
+
+        Args:
+            slot (int): Index of the drum sound.
+            vel (int): MIDI velocity of the hit.
+            position (int, optional): See `voice`.
+        """
+        if self.samples[slot] is None or not vel:
+            return
+        if group := CHOKE_GROUPS.get(SLOTS[slot]):
+            for voice in self.playing:
+                if CHOKE_GROUPS.get(SLOTS[voice[4]]) == group:
+                    # fade from where the choking hit starts, not from the start of the block
+                    fade_at = voice[1] + max(-position, 0)
+                    voice[5] = fade_at if voice[5] is None else min(voice[5], fade_at)
+        self.playing.append(self.voice(slot, vel, position))
+
+    def handle(self, msg):
+        """
+        Start a note.
+
+        Args:
+            msg (MidiMessage): Incoming MIDI message.
+        """
+        # Add notes to be played based on received MIDI messages
+        if msg.type == "note_on":
+            self.trigger(msg.note % 12, msg.vel)
+
+    def render(self, frames):
+        """
+        Mix the next block into the preallocated buffer.
+
+        Args:
+            frames (int): Number of frames to mix.
+
+        Returns:
+            np.ndarray: View of the buffer holding the block.
+        """
+        play_buffer, self.playing = mix_block(self.playing, frames, self.buffer)
+        return play_buffer
+
+
+def calibration_render(sampler, frames):
+    """
+    Mix a block with every sample of the kit playing, used to calibrate the block size.
+
+    Args:
+        sampler (DrumSampler): Sampler with the kit loaded.
+        frames (int): Number of frames to mix.
+    """
+    playing = [sampler.voice(slot, 127) for slot, layers in enumerate(sampler.samples) if layers]
+    mix_block(playing, frames, sampler.buffer)
 
 
 def main():
     """
     Main function to run the drum sampler.
     """
-    # Initialize MIDI input port
-    in_port = MidiPort("Python Drum Sampler", "in", True if len(sys.argv) == 1 else sys.argv[1])
-    # Initialize default speaker
-    speaker = soundcard.default_speaker()
+    # i.e. --log=sampler.log
+    setup_logging()
+    # soundcard and scipy are slow to import, let them load while the port is set up
+    preload("soundcard", "scipy.io.wavfile")
+    elevate_priority()
+    # Optionally replay a MIDI capture instead, --replay=take.midi with --speed=fast
+    # to render it as fast as possible without a speaker, i.e. for benchmarking
+    replay = get_option("replay")
+    fast = get_option("speed") == "fast"
+    if replay:
+        in_port = MidiReplayPort(replay)
+    else:
+        # Initialize MIDI input port
+        in_port = MidiPort(DrumSampler.name, "in", get_connect())
+        # Optionally capture the incoming MIDI, i.e. --midi-record=take.midi
+        if midi_record := get_option("midi-record"):
+            in_port.record(midi_record)
     # Get a list of available drumkits
     drumkits = sorted(os.listdir(os.path.join(PATH, "drumkits")))
-    print("\033c")  # Clear the screen
-    print(json.dumps(dict(enumerate(drumkits)), indent=4))  # Print available drumkits
-    kit_number = int(input("Select drumkit id: "))  # Prompt user to select a drumkit
+    kit_number = select_kit(drumkits)
 
     # Load samples for the selected drumkit
     samples, sample_rate = load_samples(drumkits, kit_number)
-    playing = []
-
-    # Initialize curses for keyboard input
-    stdscr = curses.initscr()
-    curses.noecho()
-    curses.cbreak()
-    stdscr.keypad(True)
-    stdscr.nodelay(True)
+    sampler = DrumSampler(samples, sample_rate)
+    stats = RenderStats(sample_rate) if replay else None
+    if replay and fast:
+        player = NullPlayer()
+    else:
+        import soundcard
+
+        # Initialize default speaker
+        speaker = soundcard.default_speaker()
+        player = speaker.player(samplerate=sample_rate, blocksize=512)
+
+    # Optionally record everything sent to the speaker, i.e. --record=take.wav
+    recorder = None
+    if record := get_option("record"):
+        recorder = StreamRecorder(record, sample_rate, sampler.channels, max_frames=MAX_BLOCK)
+
+    # Optionally tune the block size to this machine, --tune=calibrate or --tune=adaptive
+    tune = get_option("tune")
+
+    # Initialize curses for keyboard input, unless running without a terminal
+    stdscr = None
+    if sys.stdin.isatty():
+        stdscr = curses.initscr()
+        curses.noecho()
+        curses.cbreak()
+        stdscr.keypad(True)
+        stdscr.nodelay(True)
     try:
         # Discard any pending MIDI messages
-        for msg in in_port.iter_pending():
-            pass
+        if not replay:
+            for msg in in_port.iter_pending():
+                pass
         # Start processing MIDI messages and playing sounds
-        with speaker.player(samplerate=sample_rate, blocksize=512) as spk:
+        with player as spk:
+            chop_size = CHOP_SIZE
+            tuner = None
+            if tune:
+                tuner = BlockSizeTuner(
+                    sample_rate, CHOP_SIZE, getattr(spk, "latency", None), tune == "adaptive"
+                )
+                chop_size = tuner.calibrate(partial(calibration_render, sampler))
             while True:
                 # Check for new MIDI messages
                 for msg in in_port.iter_pending():
-                    # Add notes to be played based on received MIDI messages
-                    if msg.type == "note_on" and samples[msg.note % 12] is not None:
-                        playing.append([msg.note % 12, CHOP_SIZE])
-                # Initialize buffer for playing sounds
-                play_buffer = np.zeros_like(samples[0][:CHOP_SIZE]).astype(float)
-                kill = []
-                # Generate audio buffer based on currently playing notes
-                for idx, note in enumerate(playing):
-                    try:
-                        sample_chunk = samples[note[0]][note[1] : note[1] + CHOP_SIZE]
-                        play_buffer += np.pad(
-                            sample_chunk,
-                            (0, CHOP_SIZE - sample_chunk.shape[0]),
-                            "constant",
-                            constant_values=(0),
-                        )
-                        if playing[idx][1] > samples[note[0]].shape[0]:
-                            kill.append(idx)
-                        playing[idx][1] += CHOP_SIZE
-                    except TypeError:
-                        kill.append(idx)
-                # Remove finished notes from the list of playing notes
-                for i in kill:
-                    playing[i] = 0
-                playing = [i for i in playing if i]
+                    sampler.handle(msg)
+                start = perf_counter()
+                play_buffer = sampler.render(chop_size)
+                render_time = perf_counter() - start
                 # Play the generated audio buffer
                 spk.play(play_buffer)
+                log_startup()
+                if recorder:
+                    # offline renders have no deadline, they wait rather than drop blocks
+                    recorder.push(play_buffer, wait=isinstance(spk, NullPlayer))
                 # Check for keyboard input to switch drumkits
-                if 47 < (kit := stdscr.getch()) < 57:
-                    samples, _ = load_samples(drumkits, kit - 48)
+                if stdscr and 47 < (kit := stdscr.getch()) < 57:
+                    sampler.load(load_samples(drumkits, kit - 48)[0])
+                if replay:
+                    stats.add(render_time, chop_size)
+                    in_port.advance(chop_size / sample_rate)
+                    if in_port.done:
+                        break
+                if tuner:
+                    chop_size = tuner.update(render_time)
     except KeyboardInterrupt:
         pass
     finally:
         # Clean up curses
-        curses.nocbreak()
-        stdscr.keypad(False)
-        curses.echo()
-        curses.endwin()
+        if stdscr:
+            curses.nocbreak()
+            stdscr.keypad(False)
+            curses.echo()
+            curses.endwin()
+        if recorder:
+            recorder.close()
+        if in_port.recorder:
+            in_port.stop_recording()
+        if stats:
+            print(stats.summary())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+r"""
+ _______                          __               __   
+|   _   |.----.----.-----.----.--|  |.---.-.-----.|  |_ 
+|       ||  __|  __|  _  |   _|  _  ||  _  |     ||   _|
+|___|___||____|____|_____|__| |_____||___._|__|__||____|
+                                                        
+             _______        __                          
+            |    ___|.----.|  |--.-----.                
+            |    ___||  __||     |  _  |                
+            |_______||____||__|__|_____|     
+
+Algorithmic Music Generation
+
+Engine Host
+
+Runs several engines inside one audio loop, mixing them through a bus into a single
+stream on the default speaker, instead of one process and one device stream per engine.
+
+"""
+import os
+import time
+from threading import Thread, get_native_id
+
+import audio_utils
+import rtmidi_utils
+from drum_sampler import PATH, DrumSampler, load_samples, select_kit
+from poly_synth import BATCH, BLOCKS, PolySynth
+
+SAMPLE_RATE = 48000
+
+
+def make_synth():
+    """Create the polyphonic synth engine."""
+    return PolySynth(SAMPLE_RATE)
+
+
+def make_drums():
+    """Create the drum sampler engine, with its kit resampled to the host's rate."""
+    drumkits = sorted(os.listdir(os.path.join(PATH, "drumkits")))
+    return DrumSampler(*load_samples(drumkits, select_kit(drumkits), SAMPLE_RATE))
+
+
+# Engines the host can run, by the name used in the command line options
+ENGINES = {
+    "synth": make_synth,
+    "drums": make_drums,
+}
+
+
+def play(state, bus, ports, recorder=None):
+    """
+    Audio thread feeding MIDI to the engines and playing the bus on the default speaker.
+
+    Args:
+        state (dict): Shared state, the thread stops once "kill" is set.
+        bus (MixerBus): Bus mixing the engines.
+        ports (list): Input port of each engine on the bus, in the same order.
+        recorder (StreamRecorder, optional): Recorder to push every played block to.
+    """
+    # only the audio thread gets real-time priority
+    audio_utils.elevate_priority(get_native_id())
+    import soundcard
+
+    speaker = soundcard.default_speaker()
+    with speaker.player(samplerate=SAMPLE_RATE, blocksize=BLOCKS, channels=bus.channels) as spk:
+        while not state["kill"]:
+            for port, (engine, _) in zip(ports, bus.engines):
+                for msg in port.iter_pending():
+                    engine.handle(msg)
+            audio = bus.render(BATCH)
+            spk.play(audio)
+            audio_utils.log_startup()
+            if recorder:
+                recorder.push(audio)
+
+
+def main():
+    """
+    Main function to run the engines given by --engines=synth,drums (default: all of them).
+
+    Each engine's MIDI port and gain can be set with i.e. --drums-port=1 --drums-gain=0.5.
+
+    Raises:
+        ValueError: If an engine name is unknown.
+    """
+    # i.e. --log=host.log
+    audio_utils.setup_logging()
+    # soundcard is slow to import, let it load while the engines are set up
+    audio_utils.preload("soundcard")
+
+    names = audio_utils.get_option("engines", ",".join(ENGINES)).split(",")
+    if unknown := [name for name in names if name not in ENGINES]:
+        raise ValueError(f"Unknown engines {', '.join(unknown)}, choose from {', '.join(ENGINES)}")
+    engines = [ENGINES[name]() for name in names]
+    ports = [
+        rtmidi_utils.MidiPort(engine.name, "in", audio_utils.get_option(f"{name}-port", True))
+        for name, engine in zip(names, engines)
+    ]
+
+    bus = audio_utils.MixerBus(
+        max(engine.channels for engine in engines), dtype=audio_utils.get_dtype()
+    )
+    for name, engine in zip(names, engines):
+        bus.add(engine, float(audio_utils.get_option(f"{name}-gain", 1.0)))
+
+    # Optionally record everything sent to the speaker, i.e. --record=take.wav
+    recorder = None
+    if record := audio_utils.get_option("record"):
+        recorder = audio_utils.StreamRecorder(record, SAMPLE_RATE, bus.channels, max_frames=BATCH)
+
+    state = {"kill": False}
+    play_thread = Thread(target=play, args=(state, bus, ports, recorder), daemon=True)
+    play_thread.start()
+    print("\033cRunning...\n")
+
+    try:
+        while play_thread.is_alive():
+            time.sleep(0.1)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        state["kill"] = True
+        play_thread.join()
+        if recorder:
+            recorder.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,7 @@ from threading import Thread
 
 import numpy as np
 
+import audio_utils
 import rtmidi_utils
 
 SEED = int(time.time())
@@ -97,24 +98,16 @@ def play_loop(port: rtmidi_utils.MidiPort, buffer: dict) -> None:
         playing = []
 
         # Play the current set of notes
-        for note, vel in enumerate(
-            buffer["notes"][idx]
-            if idx < len(buffer["notes"])
-            else buffer["pnotes"][len(buffer["pnotes"]) // 2][idx - 16]
-        ):
-            if vel:
-                note = scale(note)
-                port.send([0x90, note, 100])
-                playing.append(note)
+        for note in step_notes(buffer, idx):
+            note = scale(note)
+            port.send([0x90, note, 100])
+            playing.append(note)
 
         idx += 1
         if idx >= len(buffer["notes"]) * 2:
             idx = 0
 
-        print("\033c")
-        print("Seed:", SEED)
-        render(transpose(buffer["notes"]), min(idx, 15))
-        render(transpose(buffer["pnotes"][len(buffer["pnotes"]) // 2]), max(idx - 16, 0) % 16)
+        show(buffer, idx)
 
         sl = max(calculate_sleep_duration(idx) - (time.time() - start), 0)
         print(sl)
@@ -125,6 +118,38 @@ def play_loop(port: rtmidi_utils.MidiPort, buffer: dict) -> None:
         port.send([0x80, note, 0])
 
 
+def step_notes(buffer: dict, idx: int) -> list:
+    """
+    Get the notes to play at a step of the loop.
+
+    :param buffer: Dictionary containing musical notes information.
+    :param idx: Current position in the loop.
+    :return: List of the drum indices to play.
+    """
+    return [
+        note
+        for note, vel in enumerate(
+            buffer["notes"][idx]
+            if idx < len(buffer["notes"])
+            else buffer["pnotes"][len(buffer["pnotes"]) // 2][idx - 16]
+        )
+        if vel
+    ]
+
+
+def show(buffer: dict, idx: int) -> None:
+    """
+    Render the current and the repeated pattern on the console.
+
+    :param buffer: Dictionary containing musical notes information.
+    :param idx: Current position in the loop.
+    """
+    print("\033c")
+    print("Seed:", SEED)
+    render(transpose(buffer["notes"]), min(idx, 15))
+    render(transpose(buffer["pnotes"][len(buffer["pnotes"]) // 2]), max(idx - 16, 0) % 16)
+
+
 def scale(note):
     if "blues" in sys.argv:
         pitch = 48
@@ -208,18 +233,48 @@ def mul(arr, value):
     return newarr
 
 
-def main() -> None:
-    """
-    Main function to run the MIDI note generation program.
+def new_buffer() -> dict:
     """
-    print("\033c")
+    Create an empty pattern buffer.
 
-    buffer = {
+    :return: Dictionary containing musical notes information.
+    """
+    return {
         "kill": False,
         "notes": zeros((16, 11)),
         "pnotes": [zeros((16, 11))],
     }
-    port = rtmidi_utils.MidiPort("Python Generative Beats", "out", True)
+
+
+def mutate(buffer: dict, samples: list) -> None:
+    """
+    Fade the pattern and add one random hit, keeping a history of patterns.
+
+    :param buffer: Dictionary containing musical notes information.
+    :param samples: Probability distributions for each drum, see `prob_from_harmonic`.
+    """
+    buffer["notes"] = mul(buffer["notes"], CONFIG["fadeout"])
+    note = random.randint(0, 10)
+    pos = random.choice(samples[note])
+    buffer["notes"][pos][note] = (random.random() < CONFIG["darkness"]) * 127
+    buffer["pnotes"].append(deepcopy(buffer["notes"]))
+
+    # Maintain buffer size
+    if len(buffer["pnotes"]) > CONFIG["repeat"] * 2:
+        buffer["pnotes"].pop(0)
+
+
+def main() -> None:
+    """
+    Main function to run the MIDI note generation program.
+    """
+    print("\033c")
+
+    buffer = new_buffer()
+    # the output has its own option, "port" is the controller the engines listen to
+    port = rtmidi_utils.MidiPort(
+        "Python Generative Beats", "out", audio_utils.get_option("out-port", True)
+    )
 
     # Generate samples based on harmonic information
     samples = list(map(prob_from_harmonic, FREQUENCY.values()))
@@ -234,16 +289,7 @@ def main() -> None:
 
     try:
         while True:
-            buffer["notes"] = mul(buffer["notes"], CONFIG["fadeout"])
-            note = random.randint(0, 10)
-            pos = random.choice(samples[note])
-            buffer["notes"][pos][note] = (random.random() < CONFIG["darkness"]) * 127
-            buffer["pnotes"].append(deepcopy(buffer["notes"]))
-
-            # Maintain buffer size
-            if len(buffer["pnotes"]) > CONFIG["repeat"] * 2:
-                buffer["pnotes"].pop(0)
-
+            mutate(buffer, samples)
             time.sleep(CONFIG["mutate"])
 
     except KeyboardInterrupt:
@@ -18,12 +18,12 @@ Create a live programming sound server that can be interacted with from another
 import math
 import os
 import struct
-import sys
 from importlib import reload
+from time import perf_counter
 
 import numpy as np
-import soundcard as sc
 
+import audio_utils
 import rtmidi_utils
 import synth_patchbay
 
@@ -34,8 +34,12 @@ DSP_WAVE_TXT = ""
 
 BLOCKS = 32
 BATCH = 256
+CALIBRATION_VOICES = 8
 
 
+# Absolute, so the synth can be started from any directory
+PATCHBAY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "synth_patchbay.py")
+
 NOT_VALID_BANNER = "\n" + "#" * 26 + "\n# Your code is not valid #\n" + "#" * 26 + "\n"
 
 
@@ -55,6 +59,20 @@ def midi_to_freq(midi):
     return 13.75 * (2 ** ((midi + 3) / 12))
 
 
+def calibration_render(frames):
+    """
+    Render a block with a busy note list, used to calibrate the block size.
+
+    Args:
+        frames (int): Number of frames to render.
+    """
+    synth_patchbay.get_sin(
+        np.arange(frames, dtype=float) / 48000,
+        [[int(midi_to_freq(60 + i)), 1, True, False] for i in range(CALIBRATION_VOICES)],
+        audio_utils.get_dtype(),
+    )
+
+
 def check_mod_reload(exception=False):
     """
     Check if the "synth_patchbay" module has changed and, if so, reload the module.
@@ -63,7 +81,7 @@ def check_mod_reload(exception=False):
     global DSP_WAVE_TXT
 
     # Read the content of "synth_patchbay.py" file
-    with open("synth_patchbay.py", encoding="utf-8") as handle:
+    with open(PATCHBAY_PATH, encoding="utf-8") as handle:
         data = handle.read()
         handle.close()
 
@@ -79,7 +97,7 @@ def check_mod_reload(exception=False):
             # If NOT_VALID_BANNER is present in the new data,
             # remove it and update the "synth_patchbay.py" file
             if NOT_VALID_BANNER in data:
-                with open("synth_patchbay.py", "w", encoding="utf-8") as handle:
+                with open(PATCHBAY_PATH, "w", encoding="utf-8") as handle:
                     handle.write(data.replace(NOT_VALID_BANNER, ""))
                     handle.close()
 
@@ -87,7 +105,7 @@ def check_mod_reload(exception=False):
             print("invalid code")
             # If a Error occurs during module reload,
             # append NOT_VALID_BANNER to "synth_patchbay.py" to mark it as not valid
-            with open("synth_patchbay.py", "a", encoding="utf-8") as handle:
+            with open(PATCHBAY_PATH, "a", encoding="utf-8") as handle:
                 handle.write(NOT_VALID_BANNER)
                 handle.close()
             data += NOT_VALID_BANNER
@@ -96,62 +114,168 @@ def check_mod_reload(exception=False):
     DSP_WAVE_TXT = data
 
 
+class PolySynth:
+    """Polyphonic synth engine playing the waveforms of the live coded `synth_patchbay`."""
+
+    name = "Python Polyphonic Synth"
+    channels = 1
+
+    def __init__(self, sample_rate=48000, max_frames=audio_utils.MAX_BLOCK, dtype=None):
+        """
+        Initialize PolySynth object.
+
+        Args:
+            sample_rate (int, optional): Sample rate to render at.
+            max_frames (int, optional): Largest block size that will be rendered.
+            dtype (np.dtype, optional): Sample format of the output, defaults to the
+                "precision" option.
+        """
+        self.sample_rate = sample_rate
+        dtype = dtype if dtype is not None else audio_utils.get_dtype()
+        self.buffer = np.zeros(max_frames, dtype=dtype)
+        self.time = 0
+        self.note_list = []
+        self.exception = False
+
+    def handle(self, msg):
+        """
+        Start or release a note.
+
+        Args:
+            msg (MidiMessage): Incoming MIDI message.
+        """
+        if msg.type == "note_on":
+            # Append a new entry to the note_list with frequency,
+            # volume press status, and growing status
+            self.note_list.append([int(midi_to_freq(msg.note)), 0, True, True])
+        elif msg.type == "note_off":
+            # Update the growing status to False for the matching entry in the note_list
+            for idx, entry in enumerate(self.note_list):
+                if entry[0] == int(midi_to_freq(msg.note)) and entry[2]:
+                    self.note_list[idx][2] = False
+
+    def render(self, frames):
+        """
+        Render the next block into the preallocated buffer.
+
+        Args:
+            frames (int): Number of frames to render.
+
+        Returns:
+            np.ndarray: View of the buffer holding the block.
+        """
+        # Every 10 iterations, check if the "synth_patchbay" module needs to be reloaded
+        if self.time % 100 == 0:
+            check_mod_reload(self.exception)
+            self.exception = False
+
+        # Generate audio samples using the "synth_patchbay" module, in the format of the
+        # buffer.  The time vector stays float64 whatever the precision, in float32 the phase
+        # degrades as the time grows
+        try:
+            audio, self.note_list = synth_patchbay.get_sin(
+                (np.arange(frames, dtype=float) + self.time) / self.sample_rate,
+                self.note_list,
+                self.buffer.dtype,
+            )
+        except self.exception:
+            pass
+        self.buffer[:frames] = audio
+
+        # Remove entries from note_list list where volume is 0 and growing status is False
+        self.note_list = [i for i in self.note_list if i[1] != 0 or i[2]]
+
+        self.time += frames
+        return self.buffer[:frames]
+
+
 def main():
     """
     Main function that initializes audio and MIDI processing and supervies the full process.
     """
-    print("Enter your password for real-time priority:")
-    # auto-renice to increase process priority
-    os.system(f"sudo renice -n -20 -p {os.getpid()}")
+    # i.e. --log=synth.log
+    audio_utils.setup_logging()
+    # soundcard is slow to import, let it load while the port is set up
+    audio_utils.preload("soundcard")
+    audio_utils.elevate_priority()
     print("\033c")
 
-    port = rtmidi_utils.MidiPort(
-        "Python Polyphonic Synth", "in", True if len(sys.argv) == 1 else sys.argv[1]
-    )
-
-    # Get the default speaker
-    default_speaker = sc.default_speaker()
+    # Optionally replay a MIDI capture instead, --replay=take.midi with --speed=fast
+    # to render it as fast as possible without a speaker, i.e. for benchmarking
+    replay = audio_utils.get_option("replay")
+    fast = audio_utils.get_option("speed") == "fast"
+    stats = audio_utils.RenderStats(48000) if replay else None
+    if replay:
+        port = rtmidi_utils.MidiReplayPort(replay)
+    else:
+        port = rtmidi_utils.MidiPort(PolySynth.name, "in", audio_utils.get_connect())
+        # Optionally capture the incoming MIDI, i.e. --midi-record=take.midi
+        if midi_record := audio_utils.get_option("midi-record"):
+            port.record(midi_record)
+
+    # Optionally record everything sent to the speaker, i.e. --record=take.wav
+    recorder = None
+    if record := audio_utils.get_option("record"):
+        recorder = audio_utils.StreamRecorder(record, 48000, max_frames=audio_utils.MAX_BLOCK)
+
+    # Optionally tune the block size to this machine, --tune=calibrate or --tune=adaptive
+    tune = audio_utils.get_option("tune")
+
+    if replay and fast:
+        player = audio_utils.NullPlayer()
+    else:
+        import soundcard as sc
+
+        # Get the default speaker
+        default_speaker = sc.default_speaker()
+        player = default_speaker.player(samplerate=48000, blocksize=BLOCKS, channels=1)
 
     # Start the audio player with the specified sample rate and block size
-    with default_speaker.player(samplerate=48000, blocksize=BLOCKS, channels=1) as spk:
-        time = 0
-        note_list = []
-        print("\033cRunning...\n")
-        exception = False
-        while True:
-            for msg in port.iter_pending():
-                if msg.type == "note_on":
-                    # Append a new entry to the note_list with frequency,
-                    # volume press status, and growing status
-                    note_list.append([int(midi_to_freq(msg.note)), 0, True, True])
-                elif msg.type == "note_off":
-                    # Update the growing status to False for the matching entry in the note_list
-                    for idx, entry in enumerate(note_list):
-                        if entry[0] == int(midi_to_freq(msg.note)) and entry[2]:
-                            note_list[idx][2] = False
-
-            # uncomment to show latency in the terminal
-            # print("\033[ASpeaker latency:", spk.latency)
-
-            # Every 10 iterations, check if the "synth_patchbay" module needs to be reloaded
-            if time % 100 == 0:
-                check_mod_reload(exception)
-                exception = False
-
-            # Generate audio samples using the "synth_patchbay" module
-            # and play them through the speaker
-            try:
-                audio, note_list = synth_patchbay.get_sin(
-                    (np.arange(BATCH, dtype=float) + time) / 48000, note_list
+    try:
+        with player as spk:
+            batch = BATCH
+            tuner = None
+            if tune:
+                tuner = audio_utils.BlockSizeTuner(
+                    48000, BATCH, getattr(spk, "latency", None), adaptive=tune == "adaptive"
                 )
-            except exception:
-                pass
-            spk.play(audio)
-
-            # Remove entries from note_list list where volume is 0 and growing status is False
-            note_list = [i for i in note_list if i[1] != 0 or i[2]]
-
-            time += BATCH
+                batch = tuner.calibrate(calibration_render)
+            synth = PolySynth(48000)
+            print("\033cRunning...\n")
+            while True:
+                for msg in port.iter_pending():
+                    synth.handle(msg)
+
+                # uncomment to show latency in the terminal
+                # print("\033[ASpeaker latency:", spk.latency)
+
+                # Generate audio samples and play them through the speaker
+                start = perf_counter()
+                audio = synth.render(batch)
+                render_time = perf_counter() - start
+                spk.play(audio)
+                audio_utils.log_startup()
+                if recorder:
+                    # offline renders have no deadline, they wait rather than drop blocks
+                    recorder.push(audio, wait=isinstance(spk, audio_utils.NullPlayer))
+
+                if replay:
+                    stats.add(render_time, batch)
+                    port.advance(batch / 48000)
+                    if port.done:
+                        break
+
+                if tuner:
+                    batch = tuner.update(render_time)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if recorder:
+            recorder.close()
+        if port.recorder:
+            port.stop_recording()
+        if stats:
+            print(stats.summary())
 
 
 if __name__ == "__main__":
@@ -16,9 +16,21 @@ Simple rtmidi wrapper
 """
 
 
+import logging
+import re
+import struct
+from threading import Lock
+
 import rtmidi
 import rtmidi.midiutil
 
+LOGGER = logging.getLogger("accordant_echo")
+
+# Capture files start with this, followed by the events
+CAPTURE_MAGIC = b"AEMIDI\x01"
+# Event header: nanoseconds since the start of the capture and message length
+CAPTURE_EVENT = struct.Struct("<QB")
+
 
 class MidiMessage:
     """
@@ -38,8 +50,8 @@ class MidiMessage:
             0x90: "note_on",
             0x80: "note_off",
         }.get(data[0], "unknown")
-        self.note = data[1]
-        self.vel = data[2]
+        self.note = data[1] if len(data) > 1 else None
+        self.vel = data[2] if len(data) > 2 else None
 
 
 class MidiPort:
@@ -52,8 +64,8 @@ class MidiPort:
         Args:
             name (str): Name of the MIDI port, will be passed to rtmidi.
             direction (str): Direction of the MIDI port, either 'in' or 'out'.
-            connect (str/bool, optional): Connection port number, None for virtual port,
-                or True for UI connection.
+            connect (str/bool, optional): Connection port number or name pattern, None or
+                'virtual' for virtual port, or True for UI connection.
 
         Raises:
             ValueError: If port direction or connection point is invalid
@@ -61,6 +73,7 @@ class MidiPort:
         self.name = name
         self.direction = direction
         self.msgs = []
+        self.recorder = None
 
         assert self.direction in ["in", "out"], ValueError(
             f"Direction must be either 'in' or 'out', got '{self.direction}'"
@@ -68,32 +81,74 @@ class MidiPort:
 
         if self.direction == "in":
             self.port = rtmidi.MidiIn()
-            if connect == True:
+            if connect is True:
                 rtmidi.midiutil.list_input_ports()
                 connect = input("    Enter to create virtual port\n\n? ")
-            if connect is None:
+            if (connect := self._resolve(connect)) is None:
                 self.port.open_virtual_port(name=self.name)
-            elif str(connect).isdigit():
-                self.port.open_port(int(connect), name=self.name)
             else:
-                raise ValueError("Invalid connection port, must be integer")
+                self.port.open_port(connect, name=self.name)
             self.port.set_callback(self._callback)
         else:
-            if connect == True:
+            if connect is True:
                 rtmidi.midiutil.list_output_ports()
                 connect = input("? ")
             self.port = rtmidi.MidiOut()
-            if connect is None:
+            if (connect := self._resolve(connect)) is None:
                 self.port.open_virtual_port(name=self.name)
-            elif str(connect).isdigit():
-                self.port.open_port(int(connect), name=self.name)
             else:
-                raise ValueError("Invalid connection port, must be integer")
+                self.port.open_port(connect, name=self.name)
+
+    def _resolve(self, connect):
+        """
+        Resolve a connection argument to a port number.
+
+        Name patterns are regular expressions, matched case insensitively against the names
+        of the available ports.
+
+        Args:
+            connect (str/int): Connection port number or name pattern, or None or 'virtual'.
+
+        Returns:
+            int: The port number, or None for a virtual port.
+
+        Raises:
+            ValueError: If no port matches the name pattern.
+        """
+        if connect is None or str(connect).lower() in ("", "virtual"):
+            return None
+        if str(connect).isdigit():
+            return int(connect)
+        for idx, port_name in enumerate(self.port.get_ports()):
+            if re.search(str(connect), port_name, re.IGNORECASE):
+                return idx
+        raise ValueError(f"Invalid connection port, no port matches '{connect}'")
 
     def _callback(self, data, _):
         """Internal callback function for MIDI input."""
+        if recorder := self.recorder:
+            recorder.write(data[0], data[1])
         self.msgs.append(data[0])
 
+    def record(self, path):
+        """
+        Start capturing every incoming message to a file.
+
+        Args:
+            path (str): File to write the capture to, see `MidiRecorder`.
+
+        Returns:
+            MidiRecorder: The recorder, see `stop_recording` to finish the capture.
+        """
+        self.recorder = MidiRecorder(path)
+        return self.recorder
+
+    def stop_recording(self):
+        """Stop capturing, detaching the recorder from the callback before closing it."""
+        if recorder := self.recorder:
+            self.recorder = None
+            recorder.close()
+
     def iter_pending(self):
         """Iterator for pending MIDI messages."""
         for _ in self.msgs[:]:
@@ -116,3 +171,117 @@ class MidiPort:
         else:
             raise ValueError("Invalid midi message, use list of three numbers")
         # FIXME add more types of acceptable messages
+
+
+class MidiRecorder:
+    """
+    Captures MIDI messages with high resolution timestamps to a compact binary file.
+
+    The timestamps are built from the delta times rtmidi takes when a message arrives, so
+    they don't depend on when the Python callback gets to run.
+
+    The file is `CAPTURE_MAGIC` followed by one `CAPTURE_EVENT` header and the raw message
+    bytes per event.
+    """
+
+    def __init__(self, path):
+        """
+        Initialize MidiRecorder object.
+
+        Args:
+            path (str): File to write the capture to.
+        """
+        self.handle = open(path, "wb")
+        self.handle.write(CAPTURE_MAGIC)
+        self.stamp = 0
+        # the callback thread may still be writing while the capture is closed
+        self.lock = Lock()
+
+    def write(self, data, delta):
+        """
+        Capture a MIDI message.
+
+        Args:
+            data (list): MIDI message data.
+            delta (float): Seconds since the previous message, as reported by rtmidi.
+        """
+        self.stamp += round(delta * 1e9)
+        with self.lock:
+            if not self.handle.closed:
+                self.handle.write(CAPTURE_EVENT.pack(self.stamp, len(data)) + bytes(data))
+                # hand every event to the OS, so a crashed or killed session keeps it
+                self.handle.flush()
+
+    def close(self):
+        """Finish the capture."""
+        with self.lock:
+            self.handle.close()
+
+
+class MidiReplayPort:
+    """
+    Replays a capture written by `MidiRecorder` in place of an input `MidiPort`.
+
+    The replay runs on the clock of the engine rather than the wall clock: the engine calls
+    `advance` for every block it renders, so a replay delivers the same messages to the
+    same blocks every time, whether it is played in real time or as fast as possible.
+    """
+
+    def __init__(self, path, tail=2.0):
+        """
+        Initialize MidiReplayPort object.
+
+        Args:
+            path (str): Capture file to replay.
+            tail (float, optional): Seconds to keep going after the last message.
+
+        Raises:
+            ValueError: If the file is not a MIDI capture.
+        """
+        self.name = path
+        self.direction = "in"
+        self.recorder = None
+        self.events = []
+        with open(path, "rb") as handle:
+            if handle.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+                raise ValueError(f"'{path}' is not a MIDI capture")
+            while header := handle.read(CAPTURE_EVENT.size):
+                if len(header) == CAPTURE_EVENT.size:
+                    stamp, length = CAPTURE_EVENT.unpack(header)
+                    data = handle.read(length)
+                    if len(data) == length:
+                        self.events.append((stamp / 1e9, list(data)))
+                        continue
+                # the capture was cut off mid-event, i.e. the recording process was killed
+                LOGGER.warning(
+                    "'%s' ends with a truncated event, replaying the %d complete events",
+                    path,
+                    len(self.events),
+                )
+                break
+        # start replaying at the first message rather than when the capture was started
+        first = self.events[0][0] if self.events else 0
+        self.events = [(stamp - first, data) for stamp, data in self.events]
+        self.length = self.events[-1][0] + tail if self.events else tail
+        self.position = 0.0
+        self.next = 0
+
+    @property
+    def done(self):
+        """Whether the replay, including its tail, is over."""
+        return self.position >= self.length
+
+    def advance(self, seconds):
+        """
+        Advance the replay clock.
+
+        Args:
+            seconds (float): Duration of the block the engine just rendered.
+        """
+        self.position += seconds
+
+    def iter_pending(self):
+        """Iterator for messages due at the current position of the replay."""
+        while self.next < len(self.events) and self.events[self.next][0] <= self.position:
+            yield MidiMessage(self.events[self.next][1])
+            self.next += 1
@@ -26,27 +26,34 @@ ATTACK = 10
 DECAY = 10
 SUSTAIN = 1
 RELEASE = 10
+# The envelope times above count steps of this many frames, whatever the block size
+ENVELOPE_FRAMES = 256
 
 
-def sin(t, note, mul):
+def phase(t, note, mul, dtype=float):
+    """Wrap the phase to [0, 2) in float64, only then is it precise enough for dtype."""
+    return ((t * note[0] * mul) % 2).astype(dtype, copy=False)
+
+
+def sin(t, note, mul, dtype=float):
     """Generate a sine wave."""
-    return (np.sin(t * math.pi * note[0] * mul)) * note[1] * 0.5
+    return (np.sin(phase(t, note, mul, dtype) * math.pi)) * note[1] * 0.5
 
 
-def saw(t, note, mul):
+def saw(t, note, mul, dtype=float):
     """Generate a sawtooth wave."""
-    return (((t * note[0] * mul) % 2) - 1) * note[1]
+    return (phase(t, note, mul, dtype) - 1) * note[1]
 
 
-def sqr(t, note, mul):
+def sqr(t, note, mul, dtype=float):
     """Generate a square wave."""
-    return ((((t * note[0] * mul) % 2) - 1) * 2).astype(int) * note[1]
+    return np.trunc((phase(t, note, mul, dtype) - 1) * 2) * note[1]
 
 
-def detune(fun, args, amount, spread):
+def detune(fun, args, amount, spread, dtype=float):
     """Apply detuning to a given waveform."""
     return sum(
-        fun(args[0], args[1], args[-1] + ((i / spread) * amount))
+        fun(args[0], args[1], args[-1] + ((i / spread) * amount), dtype)
         for i in range(-spread, spread + 1)
     )
 
@@ -54,12 +61,13 @@ def detune(fun, args, amount, spread):
 pvalue = None
 
 
-def get_sin(t, note_list):
+def get_sin(t, note_list, dtype=float):
     global pvalue
     # TODO LFOs
 
-    # Initialize
-    value = np.zeros(t.shape)
+    # Initialize, t is float64 but the waveforms are summed in dtype
+    value = np.zeros(t.shape, dtype=dtype)
+    step = t.shape[0] / ENVELOPE_FRAMES
     for idx, note in enumerate(note_list[:]):
         ##################################
         #            WAVEFORM            #
@@ -67,16 +75,16 @@ def get_sin(t, note_list):
 
         ###################################
         # simple square wave
-        value += sqr(t, note, 1) * 0.5
+        value += sqr(t, note, 1, dtype) * 0.5
         ###################################
         # drawbar organ
-        # value += sin(t, note, 1)
-        # value += sin(t, note, 0.5)
-        # value += sin(t, note, 2)
+        # value += sin(t, note, 1, dtype)
+        # value += sin(t, note, 0.5, dtype)
+        # value += sin(t, note, 2, dtype)
 
         ###################################
         # supersaw
-        # value += detune(saw, (t, note, 1), 0.01, 2)
+        # value += detune(saw, (t, note, 1), 0.01, 2, dtype)
         ###################################
 
         ##################################
@@ -92,12 +100,12 @@ def get_sin(t, note_list):
 
         # Release
         if not note[2]:
-            note_list[idx][1] -= 1 / RELEASE
+            note_list[idx][1] -= step / RELEASE
         # Attack
         # if growing and we're not at full volume
         elif note[3] and note[1] < 1:
             # increase volume
-            note_list[idx][1] += 1 / ATTACK
+            note_list[idx][1] += step / ATTACK
         # if we're growing and we are at full volume
         elif note[3]:
             # stop growing
@@ -106,7 +114,7 @@ def get_sin(t, note_list):
         # if we're not growing
         elif not note[3] and note[1] > SUSTAIN and DECAY:
             # decrease volume unless we are at sustain level
-            note_list[idx][1] -= 1 / DECAY
+            note_list[idx][1] -= step / DECAY
 
         # keep things reasonable
         note_list[idx][1] = max(min(note_list[idx][1], 1.01), 0)
@@ -129,4 +137,4 @@ def get_sin(t, note_list):
 def moving_average(a, n=3):
     ret = np.cumsum(a, dtype=float)
     ret[n:] = ret[n:] - ret[:-n]
-    return ret[n - 1 :] / n
+    return (ret[n - 1 :] / n).astype(a.dtype, copy=False)